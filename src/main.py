@@ -1,77 +1,72 @@
+from __future__ import annotations
+
+import asyncio
+import fnmatch
+import hashlib
 import io
-import json
 import logging
 import os
 import re
-from typing import Optional
-
-import openai
+import sqlite3
+from contextlib import closing
+from functools import lru_cache
+from itertools import groupby
+from pathlib import Path
+from typing import TYPE_CHECKING, List, Optional, Set, Tuple
+
+import orjson
 import requests
-from github import Github
-from unidiff import PatchSet
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+if TYPE_CHECKING:
+    import openai
+    import tiktoken
+    from unidiff import PatchedFile, PatchSet
 
 GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_API_MODEL = os.getenv("OPENAI_API_MODEL")
-
-client = openai.OpenAI(api_key=OPENAI_API_KEY)
-github_client = Github(GITHUB_TOKEN)
-
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+REVIEW_CACHE_PATH = os.getenv(
+    "REVIEW_CACHE_PATH",
+    os.path.join(os.path.expanduser("~"), ".cache", "code-reviewer", "reviews.sqlite")
+)
+
+EXCLUDE_PATTERNS = [pattern.strip() for pattern in os.getenv("EXCLUDE", "").split(",") if pattern.strip()]
+LOCK_FILE_NAMES = {"package-lock.json", "yarn.lock", "pnpm-lock.yaml", "poetry.lock"}
+SKIP_SUFFIXES = (".lock", ".md", ".png", ".jpg", ".svg", ".map")
+SKIP_PREFIXES = ("vendor/", "node_modules/", "dist/")
+
+BATCH_MODE = os.getenv("CODE_REVIEWER_BATCH", "").lower() in ("1", "true")
+BATCH_ID = os.getenv("CODE_REVIEWER_BATCH_ID")
+BATCH_TERMINAL_STATUSES = ("failed", "expired", "cancelled")
+MAX_DIFF_TOKENS = int(os.getenv("MAX_DIFF_TOKENS", "8000"))
+OPENAI_CONTEXT_TOKENS = os.getenv("OPENAI_CONTEXT_TOKENS")
+MAX_RESPONSE_TOKENS = 1000
+# Chat message framing around the system and user messages is not counted exactly.
+PROMPT_OVERHEAD_TOKENS = 100
+MIN_DIFF_TOKENS = 1000
+MIN_DEDUP_LINE_LENGTH = 10
+MODEL_CONTEXT_TOKENS = {
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-4-turbo": 128000,
+    "gpt-4o": 128000,
+    "gpt-4.1": 1047576,
+    "gpt-3.5-turbo": 16385,
+}
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "8"))
+
+CODE_FENCE_PATTERN = re.compile(r"```\w*")
+REVIEW_SEPARATOR = "\n\n---\n\n"
+
+logging.basicConfig(
+    level=logging.DEBUG if os.getenv("RUNNER_DEBUG") == "1" else logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
 logger = logging.getLogger()
 
-
-class PullRequestDetails:
-    def __init__(self, owner: str, repo: str, pull_number: int, title: str, description: str):
-        self.owner = owner
-        self.repo = repo
-        self.pull_number = pull_number
-        self.title = title
-        self.description = description
-
-
-def get_pull_request_details() -> PullRequestDetails:
-    logger.debug("Getting PR details...")
-    with open(os.getenv("GITHUB_EVENT_PATH"), "r") as file:
-        event_data = json.load(file)
-
-    owner = event_data["repository"]["owner"]["login"]
-    repo = event_data["repository"]["name"]
-    pull_number = event_data["pull_request"]["number"]
-
-    repo_obj = github_client.get_repo(f"{owner}/{repo}")
-    pr = repo_obj.get_pull(pull_number)
-
-    logger.debug(f"PR details: owner={owner}, repo={repo_obj.name}, pull_number={pull_number}, title={pr.title}")
-
-    return PullRequestDetails(
-        owner=owner,
-        repo=repo_obj.name,
-        pull_number=pull_number,
-        title=pr.title,
-        description=pr.body
-    )
-
-
-def get_diff(owner: str, repo: str, pull_number: int) -> Optional[str]:
-    logger.debug(f"Getting diff for PR {pull_number} in repo {owner}/{repo}...")
-    url = f"https://api.github.com/repos/{owner}/{repo}/pulls/{pull_number}"
-    response = requests.get(url, headers={"Authorization": f"token {GITHUB_TOKEN}"})
-    pr_data = response.json()
-    diff_url = pr_data.get("diff_url")
-
-    if diff_url:
-        diff_response = requests.get(diff_url)
-        logger.debug("Diff fetched successfully.")
-        return diff_response.text
-
-    logger.warning(f"No diff URL found for PR {pull_number}")
-    return None
-
-
-def create_prompt(aggregated_diff: str, pr_details: PullRequestDetails) -> str:
-    return f"""
-You are an automated code review assistant. Your review output **must** follow the structure below **exactly**:
+SYSTEM_PROMPT = """You are an automated code review assistant. Your review output **must** follow the structure below **exactly**:
 
 [AI Review]
 
@@ -127,14 +122,111 @@ You are an automated code review assistant. Your review output **must** follow t
 개선된 java 코드블럭
 ```
 **
+"""
 
-Pull request title: {pr_details.title}
+
+@lru_cache(maxsize=1)
+def get_openai_client() -> openai.AsyncOpenAI:
+    import openai
+
+    return openai.AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=5)
+
+
+@lru_cache(maxsize=1)
+def get_github_session() -> requests.Session:
+    session = requests.Session()
+    session.headers.update({
+        "Authorization": f"token {GITHUB_TOKEN}",
+        "Accept": "application/vnd.github.v3+json"
+    })
+    session.mount("https://", HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=10,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=(429, 500, 502, 503, 504),
+            raise_on_status=False
+        )
+    ))
+    return session
+
+
+class PullRequestDetails:
+    def __init__(self, owner: str, repo: str, pull_number: int, title: str, description: str):
+        self.owner = owner
+        self.repo = repo
+        self.pull_number = pull_number
+        self.title = title
+        self.description = description
+
+    @property
+    def key(self) -> str:
+        return f"{self.owner}/{self.repo}#{self.pull_number}"
+
+
+def get_pull_request_details(event_data: dict) -> PullRequestDetails:
+    logger.debug("Getting PR details...")
+    owner = event_data["repository"]["owner"]["login"]
+    repo = event_data["repository"]["name"]
+    pull_request = event_data["pull_request"]
+    pull_number = pull_request["number"]
+
+    logger.debug("PR details: owner=%s, repo=%s, pull_number=%s, title=%s", owner, repo, pull_number, pull_request["title"])
+
+    return PullRequestDetails(
+        owner=owner,
+        repo=repo,
+        pull_number=pull_number,
+        title=pull_request["title"],
+        description=pull_request.get("body") or ""
+    )
+
+
+def get_diff(owner: str, repo: str, pull_number: int) -> Optional[requests.Response]:
+    logger.debug("Getting diff for PR %s in repo %s/%s...", pull_number, owner, repo)
+    url = f"https://api.github.com/repos/{owner}/{repo}/pulls/{pull_number}"
+    response = get_github_session().get(url, headers={"Accept": "application/vnd.github.v3.diff"}, stream=True)
+
+    if response.status_code == 200:
+        logger.debug("Diff response received, streaming body.")
+        response.raw.decode_content = True
+        # urllib3 closes the stream at EOF by default, which makes TextIOWrapper fail on its final read.
+        response.raw.auto_close = False
+        return response
+
+    logger.warning(f"Failed to fetch diff for PR {pull_number}: {response.text}")
+    response.close()
+    return None
+
+
+def parse_diff_response(diff_response: requests.Response) -> PatchSet:
+    from unidiff import PatchSet
+
+    # Feed the socket straight into unidiff instead of materializing the diff as one big str first.
+    with diff_response:
+        diff_stream = io.TextIOWrapper(
+            diff_response.raw,
+            encoding=diff_response.encoding or "utf-8",
+            errors="replace",
+            newline="\n"
+        )
+        return PatchSet(diff_stream)
+
+
+def create_prompt(aggregated_diff: str, pr_details: PullRequestDetails, incremental: bool = False) -> str:
+    if incremental:
+        diff_description = "이전 리뷰 이후 Pull Request에 새로 추가된 코드 diff"
+    else:
+        diff_description = "Pull Request에서 변경된 코드 diff 전체"
+
+    return f"""Pull request title: {pr_details.title}
 Pull request description:
 ---
 {pr_details.description}
 ---
 
-아래는 Pull Request에서 변경된 코드 diff 전체입니다:
+아래는 {diff_description}입니다:
 (diff 시작)
 {aggregated_diff}
 (diff 끝)
@@ -143,22 +235,121 @@ Pull request description:
 """
 
 
-def get_ai_review_text(prompt: str) -> str:
-    logger.debug("Requesting AI review response...")
+def open_review_cache() -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(REVIEW_CACHE_PATH), exist_ok=True)
+    connection = sqlite3.connect(REVIEW_CACHE_PATH)
+    connection.execute("CREATE TABLE IF NOT EXISTS reviews (key TEXT PRIMARY KEY, review TEXT NOT NULL)")
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS reviewed_blocks "
+        "(pull_request TEXT NOT NULL, block_hash TEXT NOT NULL, PRIMARY KEY (pull_request, block_hash))"
+    )
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS collected_batches "
+        "(batch_id TEXT NOT NULL, pull_request TEXT NOT NULL, PRIMARY KEY (batch_id, pull_request))"
+    )
+    return connection
+
+
+def get_cached_review(key: str) -> Optional[str]:
     try:
-        response = client.chat.completions.create(
-            model=OPENAI_API_MODEL,
-            messages=[{"role": "system", "content": prompt}],
-            max_tokens=1000,
-            temperature=0.2,
-        )
-        logger.debug(f"AI response: {response}")
+        with closing(open_review_cache()) as connection:
+            row = connection.execute("SELECT review FROM reviews WHERE key = ?", (key,)).fetchone()
+    except (sqlite3.Error, OSError) as error:
+        logger.warning(f"Failed to read review cache: {error}")
+        return None
+    return row[0] if row else None
+
+
+def store_cached_review(key: str, review: str):
+    try:
+        with closing(open_review_cache()) as connection, connection:
+            connection.execute("INSERT OR REPLACE INTO reviews (key, review) VALUES (?, ?)", (key, review))
+    except (sqlite3.Error, OSError) as error:
+        logger.warning(f"Failed to write review cache: {error}")
+
+
+def get_reviewed_blocks(pull_request: str) -> Set[str]:
+    try:
+        with closing(open_review_cache()) as connection:
+            rows = connection.execute(
+                "SELECT block_hash FROM reviewed_blocks WHERE pull_request = ?", (pull_request,)
+            ).fetchall()
+    except (sqlite3.Error, OSError) as error:
+        logger.warning(f"Failed to read reviewed blocks: {error}")
+        return set()
+    return {row[0] for row in rows}
+
+
+def store_reviewed_blocks(pull_request: str, block_hashes: List[str]):
+    try:
+        with closing(open_review_cache()) as connection, connection:
+            connection.executemany(
+                "INSERT OR IGNORE INTO reviewed_blocks (pull_request, block_hash) VALUES (?, ?)",
+                [(pull_request, block_hash) for block_hash in block_hashes]
+            )
+    except (sqlite3.Error, OSError) as error:
+        logger.warning(f"Failed to write reviewed blocks: {error}")
+
+
+def get_collected_pull_requests(batch_id: str) -> Set[str]:
+    try:
+        with closing(open_review_cache()) as connection:
+            rows = connection.execute(
+                "SELECT pull_request FROM collected_batches WHERE batch_id = ?", (batch_id,)
+            ).fetchall()
+    except (sqlite3.Error, OSError) as error:
+        logger.warning(f"Failed to read collected batches: {error}")
+        return set()
+    return {row[0] for row in rows}
+
+
+def store_collected_pull_request(batch_id: str, pull_request: str):
+    try:
+        with closing(open_review_cache()) as connection, connection:
+            connection.execute(
+                "INSERT OR IGNORE INTO collected_batches (batch_id, pull_request) VALUES (?, ?)",
+                (batch_id, pull_request)
+            )
+    except (sqlite3.Error, OSError) as error:
+        logger.warning(f"Failed to write collected batches: {error}")
+
+
+def build_chat_request(prompt: str) -> dict:
+    return {
+        "model": OPENAI_API_MODEL,
+        "messages": [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        "max_tokens": MAX_RESPONSE_TOKENS,
+        "temperature": 0.2,
+    }
+
+
+def clean_review_text(content: Optional[str]) -> str:
+    # A refusal or a tool call comes back with no message content.
+    if content is None:
+        return ""
+    return CODE_FENCE_PATTERN.sub("", content).strip()
+
 
-        content = response.choices[0].message.content
+async def get_ai_review_text(prompt: str) -> str:
+    cache_key = hashlib.sha256(f"{OPENAI_API_MODEL}\0{SYSTEM_PROMPT}\0{prompt}".encode("utf-8")).hexdigest()
+    cached_review = get_cached_review(cache_key)
+    if cached_review is not None:
+        logger.info("Reusing cached AI review for identical prompt.")
+        return cached_review
 
-        content = re.sub(r"```(\w+)?", "", content)
-        content = content.replace("```", "").strip()
+    logger.debug("Requesting AI review response...")
+    try:
+        response = await get_openai_client().chat.completions.create(**build_chat_request(prompt))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("AI response: %s", response)
+
+        content = clean_review_text(response.choices[0].message.content)
 
+        if content:
+            store_cached_review(cache_key, content)
         return content
 
     except Exception as error:
@@ -167,78 +358,371 @@ def get_ai_review_text(prompt: str) -> str:
 
 
 # github api document [https://docs.github.com/ko/rest/pulls/reviews]
-def create_issue_comment(owner: str, repo: str, pull_number: int, body: str):
-    logger.debug(f"Creating single issue comment for PR {pull_number}...")
+def create_issue_comment(owner: str, repo: str, pull_number: int, body: str) -> bool:
+    logger.debug("Creating single issue comment for PR %s...", pull_number)
     url = f"https://api.github.com/repos/{owner}/{repo}/issues/{pull_number}/comments"
+    data = orjson.dumps({"body": body})
 
-    headers = {
-        "Authorization": f"token {GITHUB_TOKEN}",
-        "Accept": "application/vnd.github.v3+json"
-    }
-    data = {"body": body}
-
-    response = requests.post(url, json=data, headers=headers)
+    response = get_github_session().post(url, data=data, headers={"Content-Type": "application/json"})
     if response.status_code == 201:
         logger.info("Issue comment created successfully.")
-    else:
-        logger.error(f"Failed to create issue comment: {response.text}")
+        return True
 
+    logger.error(f"Failed to create issue comment: {response.text}")
+    return False
 
-def analyze_code(parsed_diff: PatchSet, pr_details: PullRequestDetails) -> str:
-    logger.debug("Analyzing code diff...")
 
-    aggregated_diff_lines = []
-    for file in parsed_diff:
-        if file.path == "/dev/null":
+async def collect_review_batch(batch_id: str):
+    logger.debug("Checking review batch %s...", batch_id)
+    batch = await get_openai_client().batches.retrieve(batch_id)
+    if batch.status in BATCH_TERMINAL_STATUSES:
+        logger.warning(f"Review batch {batch_id} is {batch.status}, no reviews to collect.")
+        return
+    if batch.status != "completed":
+        logger.info("Review batch %s is %s, nothing to collect yet.", batch_id, batch.status)
+        return
+
+    collected_pull_requests = get_collected_pull_requests(batch_id)
+    chunk_reviews = {}
+    chunk_counts = {}
+    # A batch whose requests all failed has only an error file.
+    for file_id in filter(None, (batch.output_file_id, batch.error_file_id)):
+        output = await get_openai_client().files.content(file_id)
+        for line in output.content.splitlines():
+            result = orjson.loads(line)
+            pull_request, position = result["custom_id"].rsplit(":", 1)
+            index, _, chunk_count = position.partition("/")
+            reviews = chunk_reviews.setdefault(pull_request, {})
+            # Batches submitted without a chunk count can only be checked against the results they returned.
+            chunk_counts[pull_request] = int(chunk_count) if chunk_count else chunk_counts.get(pull_request, 0) + 1
+
+            response = result.get("response") or {}
+            if response.get("status_code") != 200:
+                logger.warning(f"Batch request {result['custom_id']} failed: {result.get('error') or response}")
+                continue
+
+            content = response["body"]["choices"][0]["message"].get("content")
+            if content is None:
+                logger.warning(f"Batch request {result['custom_id']} returned no review text.")
+                continue
+            reviews[int(index)] = clean_review_text(content)
+
+    for pull_request, reviews in chunk_reviews.items():
+        if pull_request in collected_pull_requests:
+            logger.info("Review batch %s was already posted to %s.", batch_id, pull_request)
             continue
 
-        aggregated_diff_lines.append(f"diff --git a/{file.path} b/{file.path}")
-        for hunk in file:
-            for line in hunk:
-                if line.is_added:
-                    aggregated_diff_lines.append(f"+ {line.value.strip()}")
+        review_text = REVIEW_SEPARATOR.join(text for _, text in sorted(reviews.items()) if text)
+        failed_count = chunk_counts[pull_request] - len(reviews)
+        if failed_count:
+            logger.warning(f"{failed_count} of {chunk_counts[pull_request]} review chunks failed for {pull_request}.")
+        if not review_text:
+            logger.info("No comments generated by AI for %s.", pull_request)
+            store_collected_pull_request(batch_id, pull_request)
+            continue
 
-    if not aggregated_diff_lines:
-        logger.debug("No added lines found in this PR.")
-        return ""
+        # Batch results never change once completed, so say what is missing instead of waiting for it.
+        if failed_count:
+            review_text += REVIEW_SEPARATOR + (
+                f"_{failed_count} of {chunk_counts[pull_request]} diff chunks could not be reviewed "
+                f"in batch {batch_id}._"
+            )
+
+        repository, pull_number = pull_request.rsplit("#", 1)
+        owner, repo = repository.split("/", 1)
+        if create_issue_comment(owner, repo, int(pull_number), review_text):
+            store_collected_pull_request(batch_id, pull_request)
+
+
+def is_reviewable_file(file: PatchedFile) -> bool:
+    if file.path == "/dev/null" or file.is_binary_file or not file.added:
+        return False
+    if os.path.basename(file.path) in LOCK_FILE_NAMES:
+        return False
+    if file.path.endswith(SKIP_SUFFIXES) or file.path.startswith(SKIP_PREFIXES):
+        return False
+    return not any(fnmatch.fnmatch(file.path, pattern) for pattern in EXCLUDE_PATTERNS)
+
+
+# openai batch api document [https://platform.openai.com/docs/guides/batch]
+async def submit_review_batch(pr_details: PullRequestDetails, prompts: List[str]) -> str:
+    logger.debug("Submitting review batch of %s requests for PR %s...", len(prompts), pr_details.pull_number)
+    request_lines = b"".join(
+        orjson.dumps({
+            # The chunk count lets collection tell a failed chunk from one that was never sent.
+            "custom_id": f"{pr_details.key}:{index}/{len(prompts)}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": build_chat_request(prompt),
+        }) + b"\n"
+        for index, prompt in enumerate(prompts)
+    )
 
-    aggregated_diff = "\n".join(aggregated_diff_lines)
+    batch_file = await get_openai_client().files.create(file=("batch.jsonl", request_lines), purpose="batch")
+    batch = await get_openai_client().batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    logger.info("Submitted review batch %s for PR %s.", batch.id, pr_details.pull_number)
+
+    github_output = os.getenv("GITHUB_OUTPUT")
+    if github_output:
+        with open(github_output, "a") as file:
+            file.write(f"batch_id={batch.id}\n")
+    return batch.id
+
+
+def collect_diff_blocks(parsed_diff: PatchSet) -> List[Tuple[str, str]]:
+    logger.debug("Analyzing code diff...")
 
-    prompt = create_prompt(aggregated_diff, pr_details)
-    ai_review_text = get_ai_review_text(prompt)
-    return ai_review_text
+    reviewable_files = [file for file in parsed_diff if is_reviewable_file(file)]
+    skipped_count = len(parsed_diff) - len(reviewable_files)
+    if skipped_count:
+        logger.info("Skipped %s files without reviewable code changes.", skipped_count)
+
+    blocks = []
+    for file in reviewable_files:
+        for hunk in file:
+            added_lines = [f"+ {line.value.strip()}" for line in hunk if line.is_added]
+            if added_lines:
+                blocks.append((file.path, "\n".join(added_lines)))
+    return blocks
+
+
+def get_block_hash(block: Tuple[str, str]) -> str:
+    path, added_lines = block
+    return hashlib.sha256(f"{path}\0{added_lines}".encode("utf-8")).hexdigest()
+
+
+def is_dedupable_line(line: str) -> bool:
+    # Braces, `else:`, `return x;` and blank lines repeat everywhere and carry meaning only in place.
+    content = line[2:].strip()
+    return len(content) >= MIN_DEDUP_LINE_LENGTH and any(char.isalnum() for char in content)
+
+
+def render_diff_blocks(blocks: List[Tuple[str, str]]) -> str:
+    line_paths = {}
+    line_counts = {}
+    for path, added_lines in blocks:
+        for line in added_lines.split("\n"):
+            if is_dedupable_line(line):
+                line_paths.setdefault(line, set()).add(path)
+                line_counts[line] = line_counts.get(line, 0) + 1
+
+    file_diffs = []
+    first_paths = {}
+    tagged_lines = set()
+    for path, added_lines in blocks:
+        if not file_diffs or file_diffs[-1][0] != path:
+            file_diffs.append((path, [], []))
+        _, file_lines, own_lines = file_diffs[-1]
+        for line in added_lines.split("\n"):
+            # Only lines shared between files (imports, boilerplate) are sent once, tagged with their count.
+            if len(line_paths.get(line, ())) > 1:
+                first_path = first_paths.setdefault(line, path)
+                if first_path != path:
+                    file_lines.append(f"+ <same as {first_path}>")
+                    continue
+                if line not in tagged_lines:
+                    tagged_lines.add(line)
+                    line = f"{line}  // ({line_counts[line]} occurrences)"
+            file_lines.append(line)
+            own_lines.append(line)
+
+    aggregated_diff_lines = []
+    for path, file_lines, own_lines in file_diffs:
+        # A file made only of back-references adds nothing the tagged first copy doesn't already say.
+        if own_lines:
+            aggregated_diff_lines.append(f"diff --git a/{path} b/{path}")
+            aggregated_diff_lines.extend(file_lines)
+    return "\n".join(aggregated_diff_lines)
 
 
-def main():
+@lru_cache(maxsize=1)
+def get_token_encoding() -> Optional[tiktoken.Encoding]:
+    # Keep the downloaded BPE files next to the review cache so actions/cache restores them between runs.
+    os.environ.setdefault("TIKTOKEN_CACHE_DIR", os.path.join(os.path.dirname(REVIEW_CACHE_PATH), "tiktoken"))
+    import tiktoken
+
+    try:
+        try:
+            return tiktoken.encoding_for_model(OPENAI_API_MODEL)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logger.warning(f"Failed to load the tiktoken encoding, estimating token counts from text length: {e}")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    encoding = get_token_encoding()
+    if encoding is None:
+        # Roughly three bytes per token errs on the side of smaller chunks.
+        return len(text.encode("utf-8")) // 3 + 1
+    return len(encoding.encode(text))
+
+
+def get_model_context_tokens() -> int:
+    if OPENAI_CONTEXT_TOKENS:
+        return int(OPENAI_CONTEXT_TOKENS)
+
+    model = OPENAI_API_MODEL or ""
+    for prefix in sorted(MODEL_CONTEXT_TOKENS, key=len, reverse=True):
+        if model.startswith(prefix):
+            return MODEL_CONTEXT_TOKENS[prefix]
+    return MODEL_CONTEXT_TOKENS["gpt-4"]
+
+
+def get_diff_token_budget(pr_details: PullRequestDetails, incremental: bool = False) -> int:
+    prompt_tokens = count_tokens(SYSTEM_PROMPT) + count_tokens(create_prompt("", pr_details, incremental))
+    budget = get_model_context_tokens() - prompt_tokens - MAX_RESPONSE_TOKENS - PROMPT_OVERHEAD_TOKENS
+    if budget < MIN_DIFF_TOKENS:
+        logger.warning(f"Only {budget} tokens left for the diff in the model context, using {MIN_DIFF_TOKENS}.")
+        return MIN_DIFF_TOKENS
+    return min(budget, MAX_DIFF_TOKENS)
+
+
+def split_diff_block(block: Tuple[str, str], budget: int) -> List[Tuple[str, str]]:
+    path, added_lines = block
+    pieces = [[]]
+    piece_tokens = 0
+    for line in added_lines.split("\n"):
+        # A line is never split, so a single line longer than the budget still gets a piece of its own.
+        line_tokens = count_tokens(line) + 1
+        if pieces[-1] and piece_tokens + line_tokens > budget:
+            pieces.append([])
+            piece_tokens = 0
+        pieces[-1].append(line)
+        piece_tokens += line_tokens
+    return [(path, "\n".join(lines)) for lines in pieces]
+
+
+def chunk_diff_blocks(blocks: List[Tuple[str, str]], budget: int) -> List[List[Tuple[int, Tuple[str, str]]]]:
+    chunks = [[]]
+    chunk_tokens = 0
+    for path, file_blocks in groupby(enumerate(blocks), key=lambda indexed_block: indexed_block[1][0]):
+        file_blocks = list(file_blocks)
+        # Every header and block is rendered on its own line, so each one also costs the "\n" before it.
+        header_tokens = count_tokens(f"diff --git a/{path} b/{path}") + 1
+        block_tokens = [count_tokens(added_lines) + 1 for _, (_, added_lines) in file_blocks]
+
+        # Start a new chunk at a file boundary when the whole file won't fit; split by hunk only if it never fits.
+        if chunks[-1] and chunk_tokens + header_tokens + sum(block_tokens) > budget:
+            chunks.append([])
+            chunk_tokens = 0
+        chunk_tokens += header_tokens
+        for (index, block), tokens in zip(file_blocks, block_tokens):
+            # A hunk that can't fit even in an empty chunk is split at line boundaries.
+            if header_tokens + tokens > budget:
+                pieces = split_diff_block(block, budget - header_tokens)
+            else:
+                pieces = [block]
+            for piece in pieces:
+                piece_tokens = tokens if len(pieces) == 1 else count_tokens(piece[1]) + 1
+                if chunks[-1] and chunk_tokens + piece_tokens > budget:
+                    chunks.append([])
+                    chunk_tokens = header_tokens
+                chunks[-1].append((index, piece))
+                chunk_tokens += piece_tokens
+    return fit_rendered_chunks(chunks, budget)
+
+
+def fit_rendered_chunks(
+    chunks: List[List[Tuple[int, Tuple[str, str]]]],
+    budget: int
+) -> List[List[Tuple[int, Tuple[str, str]]]]:
+    # Dedup tags and back-references change the rendered size, so measure what is actually sent.
+    for position, chunk in enumerate(chunks):
+        overflow = []
+        while len(chunk) > 1 and count_tokens(render_diff_blocks([piece for _, piece in chunk])) > budget:
+            overflow.insert(0, chunk.pop())
+        if overflow and position + 1 < len(chunks):
+            chunks[position + 1][:0] = overflow
+        elif overflow:
+            chunks.append(overflow)
+    return chunks
+
+
+async def analyze_code(
+    blocks: List[Tuple[str, str]],
+    pr_details: PullRequestDetails,
+    incremental: bool = False
+) -> Tuple[str, List[Tuple[str, str]]]:
+    chunks = chunk_diff_blocks(blocks, get_diff_token_budget(pr_details, incremental))
+    logger.debug("Reviewing %s diff blocks in %s chunks...", len(blocks), len(chunks))
+
+    semaphore = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+
+    async def review_chunk(chunk: List[Tuple[int, Tuple[str, str]]]) -> str:
+        async with semaphore:
+            diff = render_diff_blocks([piece for _, piece in chunk])
+            return await get_ai_review_text(create_prompt(diff, pr_details, incremental))
+
+    review_texts = await asyncio.gather(*(review_chunk(chunk) for chunk in chunks))
+
+    # A block split across chunks only counts as reviewed when every one of its pieces was.
+    failed_indexes = {index for chunk, review_text in zip(chunks, review_texts) if not review_text for index, _ in chunk}
+    reviewed_blocks = [block for index, block in enumerate(blocks) if index not in failed_indexes]
+    return REVIEW_SEPARATOR.join(filter(None, review_texts)), reviewed_blocks
+
+
+async def main():
     logger.info("Starting PR review process...")
-    pr_details = get_pull_request_details()
+    if BATCH_ID:
+        await collect_review_batch(BATCH_ID)
+        return
+
+    event_data = orjson.loads(Path(os.environ["GITHUB_EVENT_PATH"]).read_bytes())
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Event data: %s", event_data)
 
-    with open(os.getenv("GITHUB_EVENT_PATH"), "r") as file:
-        event_data = json.load(file)
-    logger.debug(f"Event data: {event_data}")
+    pr_details = get_pull_request_details(event_data)
 
     if event_data["action"] in ["opened", "synchronize"]:
-        diff = get_diff(pr_details.owner, pr_details.repo, pr_details.pull_number)
+        diff_response = get_diff(pr_details.owner, pr_details.repo, pr_details.pull_number)
     else:
         logger.warning(f"Unsupported event: {event_data['action']}")
         return
 
-    if not diff:
+    if diff_response is None:
         logger.warning("No diff found.")
         return
 
-    parsed_diff = PatchSet(io.StringIO(diff))
+    parsed_diff = parse_diff_response(diff_response)
+
+    blocks = collect_diff_blocks(parsed_diff)
+    if not blocks:
+        logger.info("No added lines found in this PR.")
+        return
+
+    if BATCH_MODE:
+        chunks = chunk_diff_blocks(blocks, get_diff_token_budget(pr_details))
+        prompts = [create_prompt(render_diff_blocks([piece for _, piece in chunk]), pr_details) for chunk in chunks]
+        await submit_review_batch(pr_details, prompts)
+        return
 
-    review_text = analyze_code(parsed_diff, pr_details)
+    incremental = False
+    if event_data["action"] == "synchronize":
+        reviewed_hashes = get_reviewed_blocks(pr_details.key)
+        new_blocks = [block for block in blocks if get_block_hash(block) not in reviewed_hashes]
+        if not new_blocks:
+            logger.info("No new changes since the last review.")
+            return
+        incremental = len(new_blocks) < len(blocks)
+        blocks = new_blocks
+
+    review_text, reviewed_blocks = await analyze_code(blocks, pr_details, incremental)
     if not review_text:
         logger.info("No comments generated by AI.")
         return
 
-    create_issue_comment(pr_details.owner, pr_details.repo, pr_details.pull_number, review_text)
+    if create_issue_comment(pr_details.owner, pr_details.repo, pr_details.pull_number, review_text):
+        store_reviewed_blocks(pr_details.key, [get_block_hash(block) for block in reviewed_blocks])
 
 
 if __name__ == "__main__":
     try:
-        main()
+        asyncio.run(main())
     except Exception as error:
         logger.error(f"Error: {error}")
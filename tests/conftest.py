@@ -0,0 +1,6 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+# The OpenAI client refuses to construct without a key; tests never reach the API.
+os.environ.setdefault("OPENAI_API_KEY", "test")
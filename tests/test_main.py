@@ -0,0 +1,346 @@
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from types import SimpleNamespace
+
+import orjson
+import pytest
+import requests
+
+import main
+
+DIFF = (
+    b"diff --git a/app.py b/app.py\n"
+    b"index 1111111..2222222 100644\n"
+    b"--- a/app.py\n"
+    b"+++ b/app.py\n"
+    b"@@ -1,2 +1,3 @@\n"
+    b" import os\n"
+    b"+import sys\n"
+    b" print(os.getcwd())\n"
+)
+
+
+class DiffHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/vnd.github.v3.diff; charset=utf-8")
+        self.send_header("Content-Length", str(len(DIFF)))
+        self.end_headers()
+        self.wfile.write(DIFF)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def diff_server():
+    server = HTTPServer(("127.0.0.1", 0), DiffHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/"
+    server.shutdown()
+    server.server_close()
+
+
+class LocalSession:
+    def __init__(self, url: str):
+        self.url = url
+
+    def get(self, url, **kwargs):
+        return requests.get(self.url, **kwargs)
+
+
+def test_streamed_diff_is_parsed(monkeypatch, diff_server):
+    monkeypatch.setattr(main, "get_github_session", lambda: LocalSession(diff_server))
+
+    diff_response = main.get_diff("owner", "repo", 1)
+    parsed_diff = main.parse_diff_response(diff_response)
+
+    assert [file.path for file in parsed_diff] == ["app.py"]
+    assert [line.value for line in parsed_diff[0][0].target_lines() if line.is_added] == ["import sys\n"]
+
+
+@pytest.fixture
+def word_tokens(monkeypatch):
+    monkeypatch.setattr(main, "count_tokens", lambda text: len(text.split()) + text.count("\n"))
+
+
+def test_long_description_lowers_budget_to_minimum(monkeypatch, word_tokens):
+    monkeypatch.setattr(main, "OPENAI_API_MODEL", "gpt-4")
+    monkeypatch.setattr(main, "OPENAI_CONTEXT_TOKENS", None)
+    pr_details = main.PullRequestDetails("owner", "repo", 1, "title", "word " * 10000)
+
+    assert main.get_diff_token_budget(pr_details) == main.MIN_DIFF_TOKENS
+
+
+@pytest.mark.parametrize("model, context_tokens", [
+    ("gpt-4o-mini", 128000),
+    ("gpt-4-0613", 8192),
+    ("gpt-4-32k-0613", 32768),
+    ("gpt-3.5-turbo-0125", 16385),
+    ("unknown-model", 8192),
+])
+def test_model_context_is_looked_up_by_prefix(monkeypatch, model, context_tokens):
+    monkeypatch.setattr(main, "OPENAI_API_MODEL", model)
+    monkeypatch.setattr(main, "OPENAI_CONTEXT_TOKENS", None)
+
+    assert main.get_model_context_tokens() == context_tokens
+
+
+def test_context_tokens_override_model_lookup(monkeypatch):
+    monkeypatch.setattr(main, "OPENAI_API_MODEL", "gpt-4")
+    monkeypatch.setattr(main, "OPENAI_CONTEXT_TOKENS", "32000")
+
+    assert main.get_model_context_tokens() == 32000
+
+
+def test_chunks_count_file_headers(word_tokens):
+    blocks = [("a.py", "+ x = 1"), ("b.py", "+ y = 2")]
+
+    chunks = main.chunk_diff_blocks(blocks, 11)
+
+    assert chunks == [[(0, ("a.py", "+ x = 1"))], [(1, ("b.py", "+ y = 2"))]]
+
+
+def test_oversized_hunk_is_split_at_line_boundaries(word_tokens):
+    added_lines = "\n".join(f"+ line{number}" for number in range(6))
+
+    chunks = main.chunk_diff_blocks([("new.py", added_lines)], 10)
+
+    assert len(chunks) > 1
+    assert all(index == 0 for chunk in chunks for index, _ in chunk)
+    assert "\n".join(piece[1] for chunk in chunks for _, piece in chunk) == added_lines
+
+
+@pytest.mark.parametrize("blocks", [
+    [("many_hunks.py", f"+ call({number})") for number in range(2000)],
+    [(f"module{number}.py", "+ import collections.abc\n+ value = 1") for number in range(300)],
+])
+def test_rendered_chunks_stay_within_budget(word_tokens, blocks):
+    chunks = main.chunk_diff_blocks(blocks, 500)
+
+    assert len(chunks) > 1
+    assert [block for chunk in chunks for _, block in chunk] == blocks
+    for chunk in chunks:
+        assert main.count_tokens(main.render_diff_blocks([piece for _, piece in chunk])) <= 500
+
+
+def test_token_count_falls_back_when_encoding_is_unavailable(monkeypatch):
+    monkeypatch.setattr(main, "get_token_encoding", lambda: None)
+
+    assert main.count_tokens("x" * 300) == 101
+
+
+def test_render_dedups_only_non_trivial_lines_shared_across_files():
+    blocks = [
+        ("a.py", "+ import collections\n+ }\n+ }"),
+        ("b.py", "+ import collections\n+ }"),
+    ]
+
+    assert main.render_diff_blocks(blocks) == (
+        "diff --git a/a.py b/a.py\n"
+        "+ import collections  // (2 occurrences)\n"
+        "+ }\n"
+        "+ }\n"
+        "diff --git a/b.py b/b.py\n"
+        "+ <same as a.py>\n"
+        "+ }"
+    )
+
+
+def test_render_tags_first_copy_and_skips_files_with_only_repeats():
+    blocks = [
+        ("a.py", "+ self.assertTrue(x)\n+ foo()\n+ self.assertTrue(x)"),
+        ("b.py", "+ self.assertTrue(x)"),
+    ]
+
+    assert main.render_diff_blocks(blocks) == (
+        "diff --git a/a.py b/a.py\n"
+        "+ self.assertTrue(x)  // (3 occurrences)\n"
+        "+ foo()\n"
+        "+ self.assertTrue(x)"
+    )
+
+
+class FakeBatchClient:
+    def __init__(self, batch, files):
+        self.batch = batch
+        self.files_by_id = files
+        self.batches = self
+        self.files = self
+
+    async def retrieve(self, batch_id):
+        return self.batch
+
+    async def content(self, file_id):
+        return SimpleNamespace(content=self.files_by_id[file_id])
+
+
+def batch_result(custom_id, content):
+    return orjson.dumps({
+        "custom_id": custom_id,
+        "response": {"status_code": 200, "body": {"choices": [{"message": {"content": content}}]}},
+    })
+
+
+@pytest.fixture
+def posted_comments(monkeypatch, tmp_path):
+    comments = []
+    monkeypatch.setattr(main, "REVIEW_CACHE_PATH", str(tmp_path / "reviews.sqlite"))
+    monkeypatch.setattr(main, "create_issue_comment", lambda *args: comments.append(args) or True)
+    return comments
+
+
+def test_collected_batch_is_posted_once(monkeypatch, posted_comments):
+    batch = SimpleNamespace(status="completed", output_file_id="out", error_file_id=None)
+    output = b"\n".join([batch_result("owner/repo#1:1/2", "second"), batch_result("owner/repo#1:0/2", "first")])
+    monkeypatch.setattr(main, "get_openai_client", lambda: FakeBatchClient(batch, {"out": output}))
+
+    asyncio.run(main.collect_review_batch("batch_1"))
+    asyncio.run(main.collect_review_batch("batch_1"))
+
+    assert posted_comments == [("owner", "repo", 1, "first" + main.REVIEW_SEPARATOR + "second")]
+
+
+def test_partially_failed_batch_notes_missing_chunks(monkeypatch, posted_comments):
+    batch = SimpleNamespace(status="completed", output_file_id="out", error_file_id=None)
+    output = b"\n".join([batch_result("owner/repo#1:0/3", "first"), batch_result("owner/repo#1:1/3", None)])
+    monkeypatch.setattr(main, "get_openai_client", lambda: FakeBatchClient(batch, {"out": output}))
+
+    asyncio.run(main.collect_review_batch("batch_1"))
+
+    [(_, _, _, body)] = posted_comments
+    assert body.startswith("first" + main.REVIEW_SEPARATOR)
+    assert "2 of 3 diff chunks could not be reviewed" in body
+
+
+def test_failed_batch_reads_error_file(monkeypatch, posted_comments):
+    batch = SimpleNamespace(status="completed", output_file_id=None, error_file_id="err")
+    errors = orjson.dumps({"custom_id": "owner/repo#1:0/1", "response": None, "error": {"code": "invalid"}})
+    monkeypatch.setattr(main, "get_openai_client", lambda: FakeBatchClient(batch, {"err": errors}))
+
+    asyncio.run(main.collect_review_batch("batch_1"))
+
+    assert posted_comments == []
+
+
+def test_expired_batch_is_not_collected(monkeypatch, posted_comments):
+    batch = SimpleNamespace(status="expired", output_file_id=None, error_file_id=None)
+    monkeypatch.setattr(main, "get_openai_client", lambda: FakeBatchClient(batch, {}))
+
+    asyncio.run(main.collect_review_batch("batch_1"))
+
+    assert posted_comments == []
+
+
+def test_unwritable_review_cache_is_treated_as_a_miss(monkeypatch, tmp_path):
+    not_a_directory = tmp_path / "file"
+    not_a_directory.write_text("")
+    monkeypatch.setattr(main, "REVIEW_CACHE_PATH", str(not_a_directory / "reviews.sqlite"))
+
+    main.store_cached_review("key", "review")
+    main.store_reviewed_blocks("owner/repo#1", ["hash"])
+    main.store_collected_pull_request("batch_1", "owner/repo#1")
+
+    assert main.get_cached_review("key") is None
+    assert main.get_reviewed_blocks("owner/repo#1") == set()
+    assert main.get_collected_pull_requests("batch_1") == set()
+
+
+def make_diff(files):
+    diff = ""
+    for path, lines in files.items():
+        diff += f"diff --git a/{path} b/{path}\nnew file mode 100644\n--- /dev/null\n+++ b/{path}\n"
+        diff += f"@@ -0,0 +1,{len(lines)} @@\n" + "".join(f"+{line}\n" for line in lines)
+    return diff
+
+
+class ReviewRun:
+    def __init__(self, monkeypatch, tmp_path):
+        self.tmp_path = tmp_path
+        self.prompts = []
+        self.incremental_flags = []
+        self.comments = []
+        monkeypatch.setattr(main, "REVIEW_CACHE_PATH", str(tmp_path / "reviews.sqlite"))
+        monkeypatch.setattr(main, "count_tokens", lambda text: len(text.split()) + text.count("\n"))
+        monkeypatch.setattr(main, "get_diff", lambda owner, repo, pull_number: self.diff)
+        monkeypatch.setattr(main, "parse_diff_response", self.parse)
+        monkeypatch.setattr(main, "get_ai_review_text", self.review)
+        monkeypatch.setattr(main, "create_issue_comment", lambda *args: self.comments.append(args) or True)
+        create_prompt = main.create_prompt
+
+        def record_prompt(aggregated_diff, pr_details, incremental=False):
+            # The token budget measures the prompt with an empty diff; only count prompts sent for review.
+            if aggregated_diff:
+                self.incremental_flags.append(incremental)
+            return create_prompt(aggregated_diff, pr_details, incremental)
+
+        monkeypatch.setattr(main, "create_prompt", record_prompt)
+        monkeypatch.setenv("GITHUB_EVENT_PATH", str(tmp_path / "event.json"))
+
+    @staticmethod
+    def parse(diff):
+        from unidiff import PatchSet
+
+        return PatchSet(diff)
+
+    async def review(self, prompt):
+        self.prompts.append(prompt)
+        return "" if "broken" in prompt else "looks good"
+
+    def __call__(self, action, files):
+        self.diff = make_diff(files)
+        self.prompts.clear()
+        self.incremental_flags.clear()
+        self.comments.clear()
+        (self.tmp_path / "event.json").write_bytes(orjson.dumps({
+            "action": action,
+            "repository": {"owner": {"login": "owner"}, "name": "repo"},
+            "pull_request": {"number": 1, "title": "title", "body": None},
+        }))
+        asyncio.run(main.main())
+
+
+@pytest.fixture
+def review_run(monkeypatch, tmp_path):
+    return ReviewRun(monkeypatch, tmp_path)
+
+
+def test_synchronize_reviews_only_new_blocks(review_run):
+    review_run("opened", {"app.py": ["import os"]})
+    review_run("synchronize", {"app.py": ["import os"], "util.py": ["import sys"]})
+
+    [prompt] = review_run.prompts
+    assert "util.py" in prompt and "app.py" not in prompt
+    assert review_run.incremental_flags == [True]
+    assert len(review_run.comments) == 1
+
+
+def test_synchronize_without_overlap_is_not_incremental(review_run):
+    review_run("opened", {"app.py": ["import os"]})
+    review_run("synchronize", {"util.py": ["import sys"]})
+
+    assert review_run.incremental_flags == [False]
+
+
+def test_synchronize_with_nothing_new_returns_early(review_run):
+    review_run("opened", {"app.py": ["import os"]})
+    review_run("synchronize", {"app.py": ["import os"]})
+
+    assert review_run.prompts == []
+    assert review_run.comments == []
+
+
+def test_only_blocks_from_reviewed_chunks_are_stored(monkeypatch, review_run):
+    monkeypatch.setattr(main, "MAX_DIFF_TOKENS", 12)
+    files = {"app.py": ["import os"], "broken.py": ["import sys"]}
+
+    review_run("opened", files)
+
+    assert main.get_reviewed_blocks("owner/repo#1") == {main.get_block_hash(("app.py", "+ import os"))}
+
+    review_run("synchronize", files)
+
+    [prompt] = review_run.prompts
+    assert "broken.py" in prompt and "app.py" not in prompt